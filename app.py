@@ -2,59 +2,315 @@
 """
 FastAPI application for serving EPUB content with AI search
 """
+import contextlib
+import hashlib
 import json
+import mimetypes
 import os
+import posixpath
+import re
+import zipfile
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, List, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from pydantic import BaseModel
+import numpy as np
+from scipy import sparse
 import uvicorn
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Try to import vector search dependencies
 try:
     from sentence_transformers import SentenceTransformer
-    import numpy as np
-    from sklearn.metrics.pairwise import cosine_similarity
+    import torch
     VECTOR_SEARCH_AVAILABLE = True
 except ImportError:
     VECTOR_SEARCH_AVAILABLE = False
     print("Warning: sentence-transformers not available. Using keyword search only.")
 
+# Optional approximate nearest-neighbour index for vector search
+try:
+    import hnswlib
+    HNSW_AVAILABLE = True
+except ImportError:
+    HNSW_AVAILABLE = False
+
+# Optional ONNX Runtime backend for the sentence encoder
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+    ONNX_RUNTIME_AVAILABLE = True
+except ImportError:
+    ONNX_RUNTIME_AVAILABLE = False
+
+
+class OrjsonResponse(JSONResponse):
+    """JSONResponse serialized with orjson"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
 
-app = FastAPI(title="EPUB Documentation Search")
+# Serialize JSON with orjson when available
+JSONResponseClass = OrjsonResponse if orjson is not None else JSONResponse
 
-# Load content
-CONTENT_FILE = Path("content.json")
+app = FastAPI(title="EPUB Documentation Search", default_response_class=JSONResponseClass)
+
+# Load content: metadata.json holds book metadata and the TOC,
+# docs/<file>.json holds each document (written by epub_parser.py)
+METADATA_FILE = Path("metadata.json")
+DOCS_DIR = Path("docs")
+WORD_RE = re.compile(r'\w+')
+# Leading paragraphs per document kept in memory and included in its embedding text
+EMBEDDING_PARAGRAPHS = 5
 content_data = {}
 documents = []
 
-if CONTENT_FILE.exists():
-    with open(CONTENT_FILE, 'r', encoding='utf-8') as f:
-        content_data = json.load(f)
-        documents = content_data.get('content', [])
-        print(f"Loaded {len(documents)} documents")
+
+def read_json(path: Path):
+    """Read a JSON file, with orjson when available"""
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def stream_documents(entries: List[dict]):
+    """Yield each full document from disk, keeping a slim copy in `documents`"""
+    for entry in entries:
+        doc_file = DOCS_DIR / f"{entry['file']}.json"
+        if not doc_file.exists():
+            print(f"Warning: {doc_file} not found, skipping. Re-run epub_parser.py.")
+            continue
+        doc = read_json(doc_file)
+        # full_text is only needed for indexing; keep a short fallback snippet instead.
+        # Headings are kept as (text, id) tuples and paragraphs as their text only,
+        # which is much smaller than one dict per element
+        documents.append({
+            'file': doc.get('file', ''),
+            'title': doc.get('title', ''),
+            'url': doc.get('url', ''),
+            'headings': tuple((h['text'], h['id']) for h in doc.get('headings', [])),
+            'paragraphs': tuple(p['text'] for p in doc.get('paragraphs', [])[:EMBEDDING_PARAGRAPHS]),
+            'leading_snippet': doc.get('full_text', '')[:300]
+        })
+        yield doc
+
+
+def build_keyword_index(docs: Iterable[dict]):
+    """Build a sparse document-term score matrix (term counts + title boost)"""
+    vocabulary = {}  # term -> column
+    rows, cols, counts = [], [], []
+    num_docs = 0
+    for doc_id, doc in enumerate(docs):
+        num_docs += 1
+        for term, tf in Counter(WORD_RE.findall(doc.get('full_text', '').lower())).items():
+            rows.append(doc_id)
+            cols.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(tf)
+        for term in set(WORD_RE.findall(doc.get('title', '').lower())):
+            rows.append(doc_id)
+            cols.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(10)  # Boost title matches
+    
+    # CSC so selecting the query terms' columns only touches their postings;
+    # duplicate (doc, term) entries from text and title are summed
+    matrix = sparse.csc_matrix(
+        (np.array(counts, dtype=np.int32), (rows, cols)),
+        shape=(num_docs, len(vocabulary))
+    )
+    return vocabulary, matrix
+
+
+if METADATA_FILE.exists():
+    content_data = read_json(METADATA_FILE)
 else:
-    print(f"Warning: {CONTENT_FILE} not found. Run epub_parser.py first.")
+    print(f"Warning: {METADATA_FILE} not found. Run epub_parser.py first.")
+
+# Documents are read one at a time so only the slim copies stay in memory
+keyword_vocabulary, keyword_matrix = build_keyword_index(
+    stream_documents(content_data.get('documents', []))
+)
+if documents:
+    print(f"Loaded {len(documents)} documents")
+
+# Lookup tables built once; documents don't change while the server runs
+docs_by_file = {doc.get('file'): doc for doc in documents}
+toc_response = {"toc": [
+    entry for entry in content_data.get('documents', []) if entry.get('file') in docs_by_file
+]}
+
+
+@lru_cache(maxsize=256)
+def load_document(filename: str) -> dict:
+    """Read a full document from disk, without the indexing-only full_text"""
+    doc = read_json(DOCS_DIR / f"{filename}.json")
+    doc.pop('full_text', None)
+    return doc
 
 # Initialize vector search if available
+# Set ONNX_MODEL_DIR to an exported (and optionally quantized) ONNX model to encode with ONNX Runtime
+ONNX_MODEL_DIR = os.environ.get('ONNX_MODEL_DIR')
+ONNX_MODEL_FILE = os.environ.get('ONNX_MODEL_FILE', 'model.int8.onnx')
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# Embeddings and the HNSW index are cached here, keyed by embedded text and model
+CACHE_DIR = Path(".cache")
+disk_cache_stats = {'hits': 0, 'misses': 0}
 vector_model = None
 document_embeddings = None
+hnsw_index = None
+
+
+class ONNXSentenceEncoder:
+    """Sentence encoder running an ONNX export of the model on ONNX Runtime"""
+
+    def __init__(self, model_dir: str, file_name: str, max_seq_length: int = 256):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=file_name, provider='CPUExecutionProvider'
+        )
+        self.max_seq_length = max_seq_length
+
+    def encode(self, texts: List[str], batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = True):
+        """Tokenize, run the model, mean-pool and (optionally) L2-normalize"""
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors='np',
+            )
+            token_embeddings = np.asarray(self.model(**inputs).last_hidden_state, dtype=np.float32)
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled)
+        if not batches:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(batches)
+
+
+def embedding_cache_key(texts: List[str], model_id: str) -> str:
+    """Cache key for document embeddings: hash of the embedded texts plus the model"""
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    model_slug = re.sub(r'[^\w.-]+', '_', model_id)
+    return f"{digest.hexdigest()[:16]}-{model_slug}"
+
+
+def build_hnsw_index(embeddings: "np.ndarray", index_file: Path) -> "hnswlib.Index":
+    """Load the cached HNSW index for these embeddings, otherwise build and save it"""
+    index = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+    if index_file.exists():
+        index.load_index(str(index_file), max_elements=len(embeddings))
+        if index.get_current_count() == len(embeddings):
+            index.set_ef(50)
+            disk_cache_stats['hits'] += 1
+            print(f"Loaded HNSW index from {index_file}")
+            return index
+        index = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+    
+    disk_cache_stats['misses'] += 1
+    index.init_index(max_elements=len(embeddings), ef_construction=200, M=16)
+    index.add_items(embeddings, np.arange(len(embeddings)))
+    index.set_ef(50)
+    # Write to a temp file first so a running server never sees a partial index
+    tmp_file = index_file.with_name(index_file.name + '.tmp')
+    index.save_index(str(tmp_file))
+    os.replace(tmp_file, index_file)
+    print(f"Built HNSW index and saved it to {index_file}")
+    return index
+
+
+def embedding_text(doc: dict) -> str:
+    """Text fed to the sentence encoder: title, headings, then leading paragraphs"""
+    parts = [doc.get('title', '')]
+    parts.extend(text for text, _ in doc.get('headings', ()))
+    parts.extend(doc.get('paragraphs', ())[:EMBEDDING_PARAGRAPHS])
+    return ' '.join(part for part in parts if part)
+
+
+def select_reduced_precision():
+    """Pick (device_type, dtype) for reduced-precision inference, dtype None for FP32"""
+    if torch.cuda.is_available():
+        return 'cuda', torch.float16
+    # BF16 is only a win with native support; it can be slower than FP32 on older CPUs
+    bf16_supported = getattr(torch.cpu, '_is_avx512_bf16_supported', lambda: False)
+    if torch.backends.mkldnn.is_available() and bf16_supported():
+        return 'cpu', torch.bfloat16
+    return 'cpu', None
+
 
 if VECTOR_SEARCH_AVAILABLE and documents:
     try:
-        print("Loading sentence transformer model...")
-        vector_model = SentenceTransformer('all-MiniLM-L6-v2')
-        print("Generating document embeddings...")
-        # Create embeddings for each document's full text
-        document_texts = [doc.get('full_text', '') for doc in documents]
-        document_embeddings = vector_model.encode(document_texts, show_progress_bar=True)
-        print(f"Generated embeddings for {len(document_embeddings)} documents")
+        encode_context = contextlib.nullcontext()
+        if ONNX_MODEL_DIR and ONNX_RUNTIME_AVAILABLE:
+            print(f"Loading ONNX model from {ONNX_MODEL_DIR}...")
+            vector_model = ONNXSentenceEncoder(ONNX_MODEL_DIR, ONNX_MODEL_FILE)
+            model_id = f"onnx-{Path(ONNX_MODEL_DIR).name}-{ONNX_MODEL_FILE}"
+        else:
+            if ONNX_MODEL_DIR:
+                print("Warning: optimum[onnxruntime] not available. Using PyTorch model.")
+            print("Loading sentence transformer model...")
+            vector_model = SentenceTransformer(EMBEDDING_MODEL)
+            model_id = EMBEDDING_MODEL
+            device_type, reduced_dtype = select_reduced_precision()
+            if reduced_dtype is not None:
+                print(f"Using {reduced_dtype} for sentence transformer inference")
+                vector_model = vector_model.to(reduced_dtype)
+                encode_context = torch.autocast(device_type=device_type, dtype=reduced_dtype)
+                model_id = f"{EMBEDDING_MODEL}-{str(reduced_dtype).replace('torch.', '')}"
+        # The model truncates long inputs, so embed the most descriptive text first
+        document_texts = [embedding_text(doc) for doc in documents]
+        cache_key = embedding_cache_key(document_texts, model_id)
+        embeddings_file = CACHE_DIR / f"embeddings-{cache_key}.npy"
+        if embeddings_file.exists():
+            disk_cache_stats['hits'] += 1
+            document_embeddings = np.load(embeddings_file)
+            print(f"Loaded document embeddings from {embeddings_file}")
+        else:
+            disk_cache_stats['misses'] += 1
+            print("Generating document embeddings...")
+            # Larger batches amortize per-batch overhead; normalized embeddings
+            # make cosine similarity a plain dot product per query
+            with torch.inference_mode(), encode_context:
+                document_embeddings = vector_model.encode(
+                    document_texts,
+                    batch_size=128 if torch.cuda.is_available() else 64,
+                    show_progress_bar=True,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+            document_embeddings = np.ascontiguousarray(document_embeddings, dtype=np.float32)
+            # Write to a temp file first so a running server never sees a partial file
+            CACHE_DIR.mkdir(exist_ok=True)
+            tmp_file = embeddings_file.with_name(embeddings_file.name + '.tmp')
+            with open(tmp_file, 'wb') as f:
+                np.save(f, document_embeddings)
+            os.replace(tmp_file, embeddings_file)
+        if HNSW_AVAILABLE:
+            hnsw_index = build_hnsw_index(document_embeddings, CACHE_DIR / f"hnsw-{cache_key}.bin")
+        print(f"Vector search ready for {len(documents)} documents")
+        print(f"Disk cache: {disk_cache_stats['hits']} hits, {disk_cache_stats['misses']} misses")
     except Exception as e:
         print(f"Error initializing vector search: {e}")
         vector_model = None
         document_embeddings = None
+        hnsw_index = None
 
 
 class SearchRequest(BaseModel):
@@ -72,48 +328,68 @@ class SearchResult(BaseModel):
     headings: List[dict]
 
 
+def heading_dicts(doc: dict) -> List[dict]:
+    """Expand a document's (text, id) heading tuples for a search result"""
+    return [{'text': text, 'id': heading_id} for text, heading_id in doc.get('headings', ())]
+
+
 def keyword_search(query: str, limit: int = 10) -> List[SearchResult]:
     """Simple keyword-based search"""
     query_lower = query.lower()
-    query_words = set(query_lower.split())
+    query_words = set(WORD_RE.findall(query_lower))
+    
+    # Calculate simple relevance score: sum of the query terms' columns
+    columns = [keyword_vocabulary[word] for word in query_words if word in keyword_vocabulary]
+    if not columns or limit <= 0:
+        return []
+    scores = np.asarray(keyword_matrix[:, columns].sum(axis=1)).ravel()
+    
+    # Get top results, highest scores first and ties in document order
+    matched = np.flatnonzero(scores)
+    if len(matched) > limit:
+        matched = matched[np.argpartition(-scores[matched], limit - 1)[:limit]]
+    top_indices = matched[np.lexsort((matched, -scores[matched]))]
     
     results = []
-    for doc in documents:
-        text = doc.get('full_text', '').lower()
-        title = doc.get('title', '')
+    for doc_id in top_indices:
+        score = float(scores[doc_id])
+        doc = documents[doc_id]
         
-        # Calculate simple relevance score
-        score = 0
-        for word in query_words:
-            if word in text:
-                score += text.count(word)
-            if word in title.lower():
-                score += 10  # Boost title matches
+        # Find snippet
+        paragraphs = doc.get('paragraphs', ())
+        snippet = ""
+        for para in paragraphs[:3]:
+            para_lower = para.lower()
+            if any(word in para_lower for word in query_words):
+                snippet = para[:300]
+                break
         
-        if score > 0:
-            # Find snippet
-            paragraphs = doc.get('paragraphs', [])
-            snippet = ""
-            for para in paragraphs[:3]:
-                if any(word in para['text'].lower() for word in query_words):
-                    snippet = para['text'][:300]
-                    break
-            
-            if not snippet and paragraphs:
-                snippet = paragraphs[0]['text'][:300]
-            
-            results.append(SearchResult(
-                title=title,
-                file=doc.get('file', ''),
-                url=doc.get('url', ''),
-                snippet=snippet,
-                score=score,
-                headings=doc.get('headings', [])
-            ))
+        if not snippet and paragraphs:
+            snippet = paragraphs[0][:300]
+        
+        results.append(SearchResult(
+            title=doc.get('title', ''),
+            file=doc.get('file', ''),
+            url=doc.get('url', ''),
+            snippet=snippet,
+            score=score,
+            headings=heading_dicts(doc)
+        ))
     
-    # Sort by score
-    results.sort(key=lambda x: x.score, reverse=True)
-    return results[:limit]
+    return results
+
+
+@lru_cache(maxsize=2048)
+def _encode_query(query: str) -> "np.ndarray":
+    """Encode and L2-normalize a query, cached per query string"""
+    with torch.inference_mode():
+        query_embedding = vector_model.encode(
+            [query], batch_size=1, convert_to_numpy=True, normalize_embeddings=True
+        )[0]
+    query_embedding = np.array(query_embedding, dtype=np.float32)
+    # Cached arrays are shared between requests
+    query_embedding.setflags(write=False)
+    return query_embedding
 
 
 def vector_search(query: str, limit: int = 10) -> List[SearchResult]:
@@ -121,36 +397,53 @@ def vector_search(query: str, limit: int = 10) -> List[SearchResult]:
     if not vector_model or document_embeddings is None:
         return keyword_search(query, limit)
     
-    try:
-        # Encode query
-        query_embedding = vector_model.encode([query])
-        
-        # Calculate similarities
-        similarities = cosine_similarity(query_embedding, document_embeddings)[0]
-        
-        # Get top results
-        top_indices = np.argsort(similarities)[::-1][:limit]
-        
-        results = []
-        for idx in top_indices:
-            if similarities[idx] > 0.1:  # Minimum similarity threshold
-                doc = documents[idx]
-                paragraphs = doc.get('paragraphs', [])
-                snippet = paragraphs[0]['text'][:300] if paragraphs else doc.get('full_text', '')[:300]
-                
-                results.append(SearchResult(
-                    title=doc.get('title', ''),
-                    file=doc.get('file', ''),
-                    url=doc.get('url', ''),
-                    snippet=snippet,
-                    score=float(similarities[idx]),
-                    headings=doc.get('headings', [])
-                ))
+    # Encode query (errors propagate so a failed search is never cached)
+    query_embedding = _encode_query(query)
+    k = min(limit, len(documents))
+    if k <= 0:
+        return []
+    
+    if hnsw_index is not None:
+        # Approximate nearest neighbours; cosine distance is 1 - similarity
+        labels, distances = hnsw_index.knn_query(query_embedding, k=k)
+        top_indices = labels[0]
+        top_scores = 1.0 - distances[0]
+    else:
+        # Calculate similarities (document embeddings are pre-normalized)
+        similarities = document_embeddings @ query_embedding
         
-        return results
-    except Exception as e:
-        print(f"Error in vector search: {e}")
-        return keyword_search(query, limit)
+        # Get top results (partial selection, then sort only the top k)
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+        top_indices = candidates[np.argsort(-similarities[candidates])]
+        top_scores = similarities[top_indices]
+    
+    results = []
+    for idx, score in zip(top_indices, top_scores):
+        if score > 0.1:  # Minimum similarity threshold
+            doc = documents[idx]
+            paragraphs = doc.get('paragraphs', ())
+            snippet = paragraphs[0][:300] if paragraphs else doc.get('leading_snippet', '')
+            
+            results.append(SearchResult(
+                title=doc.get('title', ''),
+                file=doc.get('file', ''),
+                url=doc.get('url', ''),
+                snippet=snippet,
+                score=float(score),
+                headings=heading_dicts(doc)
+            ))
+    
+    return results
+
+
+@lru_cache(maxsize=1024)
+def _search_cached(query: str, limit: int, use_vector: bool) -> tuple:
+    """Run a search and cache the serialized results per request"""
+    if use_vector:
+        results = vector_search(query, limit)
+    else:
+        results = keyword_search(query, limit)
+    return tuple(r.model_dump() for r in results)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -171,26 +464,41 @@ async def root():
 
 
 @app.post("/api/search")
-async def search(request: SearchRequest):
-    """Search endpoint"""
+def search(request: SearchRequest):
+    """Search endpoint (sync so FastAPI runs the blocking search in its threadpool)"""
     if not documents:
         raise HTTPException(status_code=503, detail="Content not loaded")
     
-    if request.use_vector_search and VECTOR_SEARCH_AVAILABLE and vector_model:
-        results = vector_search(request.query, request.limit)
-    else:
-        results = keyword_search(request.query, request.limit)
+    use_vector = bool(request.use_vector_search and VECTOR_SEARCH_AVAILABLE and vector_model)
+    try:
+        results = _search_cached(request.query, request.limit, use_vector)
+    except Exception as e:
+        if not use_vector:
+            raise
+        # Fall back outside the cached call so a transient failure isn't cached
+        print(f"Error in vector search: {e}")
+        results = _search_cached(request.query, request.limit, False)
     
-    return {"results": [r.dict() for r in results]}
+    # Results are already plain dicts; skip FastAPI's jsonable_encoder pass
+    return JSONResponseClass({"results": list(results)})
+
+
+@app.get("/api/stats")
+async def get_stats():
+    """Get search cache statistics"""
+    return {
+        'query_embedding_cache': _encode_query.cache_info()._asdict(),
+        'search_cache': _search_cached.cache_info()._asdict(),
+        'disk_cache': disk_cache_stats
+    }
 
 
 @app.get("/api/content/{filename}")
-async def get_content(filename: str):
-    """Get content for a specific file"""
-    for doc in documents:
-        if doc.get('file') == filename:
-            return doc
-    raise HTTPException(status_code=404, detail="Content not found")
+def get_content(filename: str):
+    """Get content for a specific file (read from disk on a cache miss)"""
+    if filename not in docs_by_file:
+        raise HTTPException(status_code=404, detail="Content not found")
+    return JSONResponseClass(load_document(filename))
 
 
 @app.get("/api/metadata")
@@ -202,15 +510,7 @@ async def get_metadata():
 @app.get("/api/toc")
 async def get_toc():
     """Get table of contents"""
-    toc = []
-    for doc in documents:
-        toc.append({
-            'title': doc.get('title', ''),
-            'file': doc.get('file', ''),
-            'url': doc.get('url', ''),
-            'headings': doc.get('headings', [])
-        })
-    return {"toc": toc}
+    return JSONResponseClass(toc_response)
 
 
 # Mount static files
@@ -220,7 +520,26 @@ if static_dir.exists():
 
 # Mount EPUB content directory for images (dynamically from parsed content)
 graphics_dir = content_data.get('metadata', {}).get('graphics_dir')
-if graphics_dir:
+epub_file = content_data.get('metadata', {}).get('epub_file')
+if graphics_dir and epub_file:
+    # Graphics live inside the .epub archive; read members on demand
+    if Path(epub_file).exists():
+        epub_archive = zipfile.ZipFile(epub_file)
+        graphics_root = posixpath.dirname(graphics_dir)
+        
+        @app.get("/graphics/{path:path}")
+        def get_graphic(path: str):
+            """Serve an image from the EPUB archive"""
+            name = posixpath.normpath(posixpath.join(graphics_root, path))
+            try:
+                data = epub_archive.read(name)
+            except KeyError:
+                raise HTTPException(status_code=404, detail="Graphic not found")
+            media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            return Response(content=data, media_type=media_type)
+        
+        print(f"Serving graphics from {epub_file}: {graphics_dir}")
+elif graphics_dir:
     graphics_path = Path(graphics_dir)
     if graphics_path.exists():
         # Mount the parent directory to serve images
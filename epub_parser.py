@@ -2,92 +2,183 @@
 """
 EPUB Parser - Extracts text content from EPUB XHTML files
 
-Supports both extracted EPUB directories and .epub files.
+Supports both extracted EPUB directories and .epub files. Writes
+metadata.json (book metadata and table of contents) and one
+docs/<file>.json per document.
 """
 import os
 import re
+import sys
 import json
+import posixpath
 import zipfile
-import tempfile
-import shutil
 import xml.etree.ElementTree as ET
-from pathlib import Path
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from bs4 import BeautifulSoup, SoupStrainer
 from typing import List, Dict, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_WS_RE = re.compile(r'\s+')
+# Only build tree nodes for the title and body; skips the rest of <head>
+_CONTENT_STRAINER = SoupStrainer(['title', 'body'])
+
+
+def clean_text(text: str) -> str:
+    """Clean extracted text"""
+    # Collapse whitespace runs and trim the ends
+    return _WS_RE.sub(' ', text).strip() if text else ""
+
+
+def extract_text_from_xhtml(name: str, content: bytes) -> Optional[Dict]:
+    """Extract text content from an XHTML file
+
+    Module-level so it can be shipped to worker processes.
+    """
+    filepath = PurePosixPath(name)
+    try:
+        soup = BeautifulSoup(content.decode('utf-8'), 'lxml', parse_only=_CONTENT_STRAINER)
+        
+        # Get title
+        title_elem = soup.find('title')
+        title = title_elem.text if title_elem else filepath.stem
+        
+        # Remove script and style elements inside the body
+        for script in soup(["script", "style", "meta"]):
+            script.decompose()
+        
+        # Extract body content
+        body = soup.find('body')
+        if not body:
+            return None
+        
+        # Extract headings for structure
+        headings = []
+        for h in body.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
+            heading_text = clean_text(h.get_text())
+            heading_id = h.get('id', '')
+            if heading_text:
+                headings.append({'text': heading_text, 'id': heading_id})
+        
+        # Extract paragraphs and other text content
+        paragraphs = []
+        for p in body.find_all(['p', 'div']):
+            text = clean_text(p.get_text())
+            if text and len(text) > 10:  # Filter out very short text
+                para_id = p.get('id', '')
+                paragraphs.append({'text': text, 'id': para_id})
+        
+        # Get full text; separate element texts so words across tags stay apart
+        full_text = clean_text(body.get_text(' '))
+        
+        return {
+            'file': filepath.name,
+            'title': title,
+            'headings': headings,
+            'paragraphs': paragraphs,
+            'full_text': full_text,
+            'url': f"/content/{filepath.name}"
+        }
+    except Exception as e:
+        print(f"Error parsing {filepath}: {e}")
+        return None
+
+
+def write_json(path: Path, data):
+    """Write machine-read JSON (no indentation), with orjson when available"""
+    # Write to a temp file first so readers never see a partial file
+    tmp_path = path.with_name(path.name + '.tmp')
+    if orjson is not None:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
 
 class EPUBParser:
     def __init__(self, epub_path: str):
         self.original_path = Path(epub_path)
-        self.temp_dir = None
+        self.zf = None
         
         # Handle both .epub files and extracted directories
         if self.original_path.suffix.lower() == '.epub' and self.original_path.is_file():
-            self.temp_dir = tempfile.mkdtemp()
-            self.epub_path = Path(self.temp_dir) / "epub_content"
-            self._extract_epub()
+            # Read members straight from the archive instead of extracting to disk
+            print(f"Opening EPUB: {self.original_path}")
+            self.zf = zipfile.ZipFile(self.original_path, 'r')
+            self.names = [name for name in self.zf.namelist() if not name.endswith('/')]
         else:
-            self.epub_path = self.original_path
+            self.names = [
+                path.relative_to(self.original_path).as_posix()
+                for path in self.original_path.rglob('*') if path.is_file()
+            ]
         
         # Find the XHTML directory (handle different EPUB structures)
         self.xhtml_dir = self._find_xhtml_dir()
         self.content = []
         self.metadata = {}
     
-    def _extract_epub(self):
-        """Extract .epub file to temporary directory"""
-        print(f"Extracting EPUB: {self.original_path}")
-        with zipfile.ZipFile(self.original_path, 'r') as zip_ref:
-            zip_ref.extractall(self.epub_path)
+    def _read(self, name: str) -> bytes:
+        """Read a file from the EPUB by its archive-relative name"""
+        if self.zf is not None:
+            return self.zf.read(name)
+        return (self.original_path / name).read_bytes()
     
-    def _find_xhtml_dir(self) -> Path:
+    def _files_in(self, directory: str, suffix: str) -> List[str]:
+        """List files directly inside an archive-relative directory"""
+        return [
+            name for name in self.names
+            if posixpath.dirname(name) == directory and name.endswith(suffix)
+        ]
+    
+    def _find_xhtml_dir(self) -> Optional[str]:
         """Find the directory containing XHTML content files"""
-        # Common EPUB structures
-        possible_paths = [
-            self.epub_path / "OEBPS" / "xhtml",
-            self.epub_path / "OEBPS",
-            self.epub_path / "OPS" / "xhtml",
-            self.epub_path / "OPS",
-            self.epub_path / "EPUB" / "xhtml",
-            self.epub_path / "EPUB",
-            self.epub_path,
+        # Common EPUB structures ('' is the EPUB root)
+        possible_dirs = [
+            "OEBPS/xhtml",
+            "OEBPS",
+            "OPS/xhtml",
+            "OPS",
+            "EPUB/xhtml",
+            "EPUB",
+            "",
         ]
         
-        for path in possible_paths:
-            if path.exists() and list(path.glob("*.xhtml")):
-                return path
-            if path.exists() and list(path.glob("*.html")):
-                return path
+        for directory in possible_dirs:
+            if self._files_in(directory, ".xhtml") or self._files_in(directory, ".html"):
+                return directory
         
         # Fallback: search for any directory with xhtml/html files
-        for xhtml_file in self.epub_path.rglob("*.xhtml"):
-            return xhtml_file.parent
-        for html_file in self.epub_path.rglob("*.html"):
-            return html_file.parent
+        for suffix in (".xhtml", ".html"):
+            for name in self.names:
+                if name.endswith(suffix):
+                    return posixpath.dirname(name)
         
-        return self.epub_path / "OEBPS" / "xhtml"  # Default fallback
+        return None
     
     def cleanup(self):
-        """Clean up temporary files"""
-        if self.temp_dir and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
-            self.temp_dir = None
+        """Close the EPUB archive"""
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
         
     def parse_metadata(self):
         """Parse metadata from OPF file"""
-        # Find OPF file dynamically
-        opf_file = None
-        for pattern in ["*.opf", "**/*.opf"]:
-            opf_files = list(self.epub_path.glob(pattern))
-            if opf_files:
-                opf_file = opf_files[0]
-                break
-        
-        if not opf_file or not opf_file.exists():
+        # Find OPF file dynamically, preferring one at the EPUB root
+        opf_files = sorted(
+            (name for name in self.names if name.endswith('.opf')),
+            key=lambda name: '/' in name
+        )
+        if not opf_files:
             return {}
             
-        tree = ET.parse(opf_file)
-        root = tree.getroot()
+        root = ET.fromstring(self._read(opf_files[0]))
         
         # Extract metadata
         ns = {'dc': 'http://purl.org/dc/elements/1.1/', 'opf': 'http://www.idpf.org/2007/opf'}
@@ -112,122 +203,83 @@ class EPUBParser:
             
         return metadata
     
-    def clean_text(self, text: str) -> str:
-        """Clean extracted text"""
-        if not text:
-            return ""
-        # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text)
-        # Remove leading/trailing whitespace
-        text = text.strip()
-        return text
-    
-    def extract_text_from_xhtml(self, filepath: Path) -> Dict:
-        """Extract text content from an XHTML file"""
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Get title
-            title_elem = soup.find('title')
-            title = title_elem.text if title_elem else filepath.stem
-            
-            # Remove script and style elements
-            for script in soup(["script", "style", "meta"]):
-                script.decompose()
-            
-            # Extract body content
-            body = soup.find('body')
-            if not body:
-                return None
-                
-            # Extract headings for structure
-            headings = []
-            for h in body.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-                heading_text = self.clean_text(h.get_text())
-                heading_id = h.get('id', '')
-                if heading_text:
-                    headings.append({'text': heading_text, 'id': heading_id})
-            
-            # Extract paragraphs and other text content
-            paragraphs = []
-            for p in body.find_all(['p', 'div']):
-                text = self.clean_text(p.get_text())
-                if text and len(text) > 10:  # Filter out very short text
-                    para_id = p.get('id', '')
-                    paragraphs.append({'text': text, 'id': para_id})
-            
-            # Get full text
-            full_text = self.clean_text(body.get_text())
-            
-            return {
-                'file': filepath.name,
-                'title': title,
-                'headings': headings,
-                'paragraphs': paragraphs,
-                'full_text': full_text,
-                'url': f"/content/{filepath.name}"
-            }
-        except Exception as e:
-            print(f"Error parsing {filepath}: {e}")
-            return None
-    
     def parse_all(self) -> List[Dict]:
         """Parse all XHTML files in the EPUB"""
-        if not self.xhtml_dir.exists():
-            raise ValueError(f"XHTML directory not found: {self.xhtml_dir}")
+        if self.xhtml_dir is None:
+            raise ValueError(f"XHTML directory not found in {self.original_path}")
         
         # Get metadata
         self.metadata = self.parse_metadata()
         
-        # Store the graphics/images directory for later use
-        self.metadata['graphics_dir'] = str(self._find_graphics_dir())
+        # Store the graphics/images directory for later use. For .epub files it is
+        # a directory inside the archive, served from the archive by the app.
+        graphics_dir = self._find_graphics_dir()
+        if graphics_dir is not None and self.zf is not None:
+            self.metadata['epub_file'] = str(self.original_path.resolve())
+            self.metadata['graphics_dir'] = graphics_dir
+        elif graphics_dir is not None:
+            self.metadata['graphics_dir'] = str(self.original_path / graphics_dir)
         
         # Parse all XHTML and HTML files
-        xhtml_files = sorted(self.xhtml_dir.glob("*.xhtml"))
+        xhtml_files = sorted(self._files_in(self.xhtml_dir, ".xhtml"))
         if not xhtml_files:
-            xhtml_files = sorted(self.xhtml_dir.glob("*.html"))
+            xhtml_files = sorted(self._files_in(self.xhtml_dir, ".html"))
         
         # Filter out image-only files
-        content_files = [f for f in xhtml_files if not f.name.endswith('_images.xhtml')]
+        content_files = [f for f in xhtml_files if not f.endswith('_images.xhtml')]
         
-        parsed_content = []
-        for xhtml_file in content_files:
-            content = self.extract_text_from_xhtml(xhtml_file)
-            if content and content.get('full_text'):
-                parsed_content.append(content)
+        # Files are independent, so parse them across all cores
+        contents = (self._read(name) for name in content_files)
+        with ProcessPoolExecutor() as executor:
+            parsed = executor.map(extract_text_from_xhtml, content_files, contents, chunksize=4)
+            parsed_content = [content for content in parsed if content and content.get('full_text')]
         
         self.content = parsed_content
         return parsed_content
     
-    def _find_graphics_dir(self) -> Optional[Path]:
+    def _find_graphics_dir(self) -> Optional[str]:
         """Find the graphics/images directory in the EPUB"""
         possible_names = ['graphics', 'images', 'img', 'image', 'media']
         
-        for name in possible_names:
-            for graphics_dir in self.epub_path.rglob(name):
-                if graphics_dir.is_dir():
-                    return graphics_dir
+        for dir_name in possible_names:
+            for name in self.names:
+                parts = name.split('/')[:-1]
+                if dir_name in parts:
+                    return '/'.join(parts[:parts.index(dir_name) + 1])
         
         return None
     
-    def save_to_json(self, output_path: str):
-        """Save parsed content to JSON file"""
-        data = {
+    def save_to_json(self, output_dir: str = "."):
+        """Save metadata and TOC to metadata.json and each document to docs/<file>.json"""
+        output_dir = Path(output_dir)
+        docs_dir = output_dir / "docs"
+        docs_dir.mkdir(parents=True, exist_ok=True)
+        
+        toc = []
+        for doc in self.content:
+            toc.append({
+                'title': doc['title'],
+                'file': doc['file'],
+                'url': doc['url'],
+                'headings': doc['headings']
+            })
+            write_json(docs_dir / f"{doc['file']}.json", doc)
+        
+        write_json(output_dir / "metadata.json", {
             'metadata': self.metadata,
-            'content': self.content
-        }
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        print(f"Saved {len(self.content)} documents to {output_path}")
+            'documents': toc
+        })
+        # Drop documents left over from a previous parse only once metadata.json
+        # no longer lists them, so an interrupted run leaves a readable output
+        written = {f"{doc['file']}.json" for doc in self.content}
+        for stale in docs_dir.glob("*.json"):
+            if stale.name not in written:
+                stale.unlink()
+        print(f"Saved {len(self.content)} documents to {output_dir}")
 
 
 def get_epub_path() -> str:
     """Get EPUB path from environment variable or command line argument"""
-    import sys
-    
     # Check command line argument first
     if len(sys.argv) > 1:
         return sys.argv[1]
@@ -261,7 +313,7 @@ if __name__ == "__main__":
     parser = EPUBParser(epub_path)
     try:
         parsed = parser.parse_all()
-        parser.save_to_json("content.json")
+        parser.save_to_json(".")
         print(f"Parsed {len(parsed)} documents")
     finally:
         parser.cleanup()
@@ -32,8 +32,8 @@ if [ ! -e "$EPUB_PATH" ]; then
     exit 1
 fi
 
-# Parse EPUB if content.json doesn't exist or EPUB is newer
-if [ ! -f "content.json" ] || [ "$EPUB_PATH" -nt "content.json" ]; then
+# Parse EPUB if metadata.json doesn't exist or EPUB is newer
+if [ ! -f "metadata.json" ] || [ "$EPUB_PATH" -nt "metadata.json" ]; then
     echo "Parsing EPUB: $EPUB_PATH"
     uv run python epub_parser.py "$EPUB_PATH"
 fi